@@ -1,38 +1,85 @@
 # /usr/bin/env python
 """ Command line interface for ba_timeseries_gradients. """
 import argparse
+import importlib.util
 import logging
+import pathlib
+import sys
+from typing import TYPE_CHECKING
 
-import bids
+from ba_timeseries_gradients import exceptions, logs, parser, utils
 
-from ba_timeseries_gradients import exceptions, gradients, logs, parser, utils
+if TYPE_CHECKING:
+    import bids
 
 LOGGER_NAME = logs.LOGGER_NAME
 
 logger = logging.getLogger(LOGGER_NAME)
 
+BIDS_ARGUMENTS = (
+    "bids_subject",
+    "bids_session",
+    "bids_suffix",
+    "bids_run",
+    "bids_task",
+    "bids_space",
+    "bids_extension",
+    "bids_datatype",
+)
+
+BIDS_ENTITIES = {
+    "subject": "sub",
+    "session": "ses",
+    "task": "task",
+    "run": "run",
+    "space": "space",
+}
+
 
 def main() -> None:
     """
     The main function that runs the ba_timeseries_gradients command line interface.
+
+    Errors raised by this package are logged once here, after which the
+    program exits with status 2.
     """
     logger.debug("Parsing command line arguments...")
     args = parser.get_parser().parse_args()
 
     logger.setLevel(logging.getLevelName(args.verbose.upper()))
 
+    try:
+        _run(args)
+    except exceptions.BaseLoggingError as error:
+        logger.error(error.message)
+        sys.exit(2)
+
+
+def _run(args: argparse.Namespace) -> None:
+    """Runs the pipeline for the parsed command-line arguments.
+
+    Args:
+        args: The parsed command-line arguments.
+    """
     logger.debug("Getting input files...")
     files = _get_bids_files(args)
     output_file = args.output_dir / ("gradients." + args.output_format)
 
     if args.dry_run:
-        logger.info("Detected input files:\n%s", "\n".join(files))
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Detected input files:\n%s", "\n".join(files))
         logger.info("Output file: %s", output_file)
         return
 
     logger.debug("Checking input validity.")
     _raise_invalid_input(args, files)
 
+    # Imported here such that --help, dry runs and invalid input are not held
+    # up by importing numpy, BrainSpace and their dependencies.
+    from ba_timeseries_gradients import (  # pylint: disable=import-outside-toplevel
+        gradients,
+    )
+
     logger.info("Calculating gradient map...")
     output_gradients, lambdas = gradients.compute_gradients(
         files,
@@ -41,6 +88,7 @@ def main() -> None:
         kernel=args.kernel,
         n_components=args.n_components,
         sparsity=args.sparsity,
+        n_jobs=args.n_jobs,
     )
 
     logger.info("Saving gradient map to %s.", output_file)
@@ -58,9 +106,14 @@ def _raise_invalid_input(args: argparse.Namespace, files: list[str]) -> None:
     Raises:
         InputError: If the output file already exists and the force flag is not set.
         InputError: If no input files are found.
+        InputError: If input files are not all NIfTI or all GIFTI files.
         InputError: If input files are volume files and no parcellation is provided.
+        InputError: If the parcellation is not a NIfTI or GIFTI file.
+        InputError: If the msgpack output format is requested but msgpack is not
+            installed.
     """
-    if (args.output_dir / "gradients.h5").exists() and not args.force:
+    output_file = args.output_dir / f"gradients.{args.output_format}"
+    if output_file.exists() and not args.force:
         raise exceptions.InputError(
             "Output file already exists. Use --force to overwrite."
         )
@@ -68,15 +121,45 @@ def _raise_invalid_input(args: argparse.Namespace, files: list[str]) -> None:
     if not files:
         raise exceptions.InputError("No input files found.")
 
-    if args.parcellation is None and files[0].endswith(("nii", "nii.gz")):
+    file_types = {
+        "volume"
+        if file.endswith(utils.VOLUMETRIC_SUFFIXES)
+        else "surface"
+        if file.endswith(utils.SURFACE_SUFFIXES)
+        else "other"
+        for file in files
+    }
+    if file_types not in ({"volume"}, {"surface"}):
+        raise exceptions.InputError(
+            "Input files must be either all NIfTI or all GIFTI files."
+        )
+
+    if args.parcellation is None and file_types == {"volume"}:
         raise exceptions.InputError(
             "Must provide a parcellation if input files are volume files."
         )
 
+    if args.parcellation is not None and not str(args.parcellation).endswith(
+        utils.VOLUMETRIC_SUFFIXES + utils.SURFACE_SUFFIXES
+    ):
+        raise exceptions.InputError("Parcellation must be a NIfTI or GIFTI file.")
+
+    if args.output_format == "msgpack" and importlib.util.find_spec("msgpack") is None:
+        raise exceptions.InputError(
+            "The msgpack output format requires the msgpack package to be installed."
+        )
+
 
 def _get_bids_files(args: argparse.Namespace) -> list[str]:
     """Get the list of input files from the BIDS directory.
 
+    Only file names are indexed; JSON sidecar metadata is never read as the
+    search only filters on filename entities. If a layout cache is provided,
+    the BIDS index is loaded from it if it exists, or stored to it otherwise,
+    such that subsequent runs on the same dataset do not have to re-index the
+    BIDS directory. If the BIDS index is disabled, the files are instead
+    found by matching filenames directly, see `_glob_bids_files`.
+
     Args:
         args: The parsed command-line arguments.
 
@@ -84,19 +167,139 @@ def _get_bids_files(args: argparse.Namespace) -> list[str]:
         list[str]: The list of input files.
     """
     search_args = {
-        key.replace("bids_", ""): value
-        for key, value in args.__dict__.items()
-        if key.startswith("bids_") and key != "bids_dir" and value
+        argument.removeprefix("bids_"): value
+        for argument in BIDS_ARGUMENTS
+        if (value := getattr(args, argument))
     }
 
-    layout = bids.BIDSLayout(args.bids_dir, validate=False)
-    files: list[str] = layout.get(return_type="filename", **search_args)
+    if args.no_bids_index:
+        logger.debug("Searching BIDS files by filename.")
+        files = _glob_bids_files(args.bids_dir, search_args)
+    else:
+        layout = _get_bids_layout(args)
+        files = layout.get(return_type="filename", **search_args)
 
     logger.info("Found %d input files.", len(files))
-    logger.debug("Input files: %s", files)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Input files: %s", files)
 
     return files
 
 
+def _get_bids_layout(args: argparse.Namespace) -> "bids.BIDSLayout":
+    """Indexes the BIDS directory with pybids, or loads its cached index.
+
+    pybids takes the dataset root from a cached index rather than from its
+    arguments. If the layout cache holds the index of a different BIDS
+    directory, it is therefore re-indexed and overwritten.
+
+    Args:
+        args: The parsed command-line arguments.
+
+    Returns:
+        bids.BIDSLayout: The BIDS layout of the BIDS directory.
+    """
+    import bids  # pylint: disable=import-outside-toplevel
+
+    if args.layout_cache is not None:
+        logger.debug("Using BIDS layout cache at %s.", args.layout_cache)
+
+    def get_layout(reset_database: bool) -> bids.BIDSLayout:
+        return bids.BIDSLayout(
+            args.bids_dir,
+            validate=False,
+            database_path=args.layout_cache,
+            reset_database=reset_database,
+            indexer=bids.BIDSLayoutIndexer(validate=False, index_metadata=False),
+        )
+
+    layout = get_layout(reset_database=False)
+    if pathlib.Path(layout.root).resolve() != args.bids_dir.resolve():
+        logger.warning(
+            "BIDS layout cache %s belongs to %s; re-indexing %s.",
+            args.layout_cache,
+            layout.root,
+            args.bids_dir,
+        )
+        layout = get_layout(reset_database=True)
+    return layout
+
+
+def _glob_bids_files(
+    bids_dir: pathlib.Path, search_args: dict[str, str | list[str]]
+) -> list[str]:
+    """Get the list of input files by matching BIDS filenames.
+
+    This bypasses pybids entirely; only the subject directories are walked
+    and filenames are parsed into entities, without reading any metadata.
+
+    Args:
+        bids_dir: The BIDS directory.
+        search_args: The BIDS entities to filter on, as passed to pybids.
+
+    Returns:
+        list[str]: The sorted list of matching files.
+    """
+    files = [
+        str(path)
+        for path in bids_dir.glob("sub-*/**/sub-*")
+        if _matches_bids_entities(path, search_args)
+    ]
+    return sorted(files)
+
+
+def _matches_bids_entities(
+    path: pathlib.Path, search_args: dict[str, str | list[str]]
+) -> bool:
+    """Checks whether a BIDS filename matches the requested entities.
+
+    Args:
+        path: The path of the file.
+        search_args: The BIDS entities to filter on, as passed to pybids.
+
+    Returns:
+        bool: True if the file matches all entities, False otherwise.
+    """
+    stem, _, extension = path.name.partition(".")
+    *key_values, suffix = stem.split("_")
+    entities = dict(key_value.partition("-")[::2] for key_value in key_values)
+    file_values: dict[str, str | None] = {
+        "suffix": suffix,
+        "extension": "." + extension,
+        "datatype": path.parent.name,
+    }
+    for key, short_key in BIDS_ENTITIES.items():
+        file_values[key] = entities.get(short_key)
+
+    for key, value in search_args.items():
+        targets = value if isinstance(value, list) else [value]
+        file_value = _normalize_bids_value(key, file_values[key])
+        if file_value not in {_normalize_bids_value(key, t) for t in targets}:
+            return False
+    return True
+
+
+def _normalize_bids_value(key: str, value: str | None) -> str | None:
+    """Normalizes a BIDS entity value for comparison.
+
+    Extensions are compared with a leading dot, and runs as integers, such
+    that e.g. `run-01` matches a requested run of `1`, as in pybids.
+
+    Args:
+        key: The name of the entity.
+        value: The value of the entity.
+
+    Returns:
+        str | None: The normalized value.
+    """
+    if value is None:
+        return None
+    if key == "extension":
+        return "." + value.lstrip(".")
+    if key == "run" and value.isdigit():
+        return str(int(value))
+    return value
+
+
 if __name__ == "__main__":
     main()
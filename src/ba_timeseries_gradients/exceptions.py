@@ -1,19 +1,15 @@
 """ Custom exceptions for the ba_timeseries_gradients package. """
-import logging
-
-from ba_timeseries_gradients import logs
-
-LOGGER_NAME = logs.LOGGER_NAME
-
-logger = logging.getLogger(LOGGER_NAME)
 
 
 class BaseLoggingError(Exception):
-    """Base exception for logging errors."""
+    """Base exception for errors that are logged by the command line interface.
+
+    The message is not logged when the exception is created; `cli.main` logs
+    it once if the exception reaches it.
+    """
 
     def __init__(self, message: str):
         self.message = message
-        logger.error(self.message)
         super().__init__(self.message)
 
 
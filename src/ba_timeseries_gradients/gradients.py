@@ -1,16 +1,19 @@
 """ Module for computing gradients. """
+import itertools
 import logging
 import pathlib
+import threading
 from collections import abc
+from concurrent import futures
+from typing import TYPE_CHECKING
 
-import nibabel as nib
 import numpy as np
-from brainspace import gradient
-from brainspace.utils import parcellation as brainspace_parcellation
-from nibabel import filebasedimages
 from numpy import typing as npt
 
-from ba_timeseries_gradients import exceptions, logs
+from ba_timeseries_gradients import exceptions, logs, utils
+
+if TYPE_CHECKING:
+    from scipy import sparse
 
 LOGGER_NAME = logs.LOGGER_NAME
 
@@ -18,24 +21,31 @@ logger = logging.getLogger(LOGGER_NAME)
 
 
 def compute_gradients(
-    files: abc.Collection[str | pathlib.Path],
+    files: abc.Iterable[str | pathlib.Path],
     *,
     parcellation_file: str | pathlib.Path | None = None,
     approach: str = "dm",
     kernel: str = "cosine",
     n_components: int = 10,
     sparsity: float = 0.9,
+    n_jobs: int = 1,
 ) -> tuple[np.ndarray, np.ndarray]:
     """Computes the gradients for a collection of files.
 
     Args:
-        files: A collection of file paths containing timeseries data.
+        files: An iterable of file paths containing timeseries data. Files
+            are consumed lazily, so this may be a generator. All files must be
+            of the same type, which is determined from the first file.
         parcellation_file: A file path containing parcellation data. If None,
             the timeseries data is not parcellated.
         approach: The dimensionality reduction approach to use.
         kernel: The kernel to use for the gradient computation.
         n_components: The number of gradient components to compute.
         sparsity: The sparsity level to use for the gradient computation.
+        n_jobs: The number of files to process concurrently. Each concurrent
+            file holds its image and a region-by-region matrix in memory, and
+            its matrix product runs on its own BLAS threads, so raise this only
+            if memory allows and loading the files dominates the run time.
 
     Returns:
         numpy.ndarray: The computed gradients.
@@ -47,8 +57,20 @@ def compute_gradients(
         parameters, please refer to the BrainSpace documentation:
         https://brainspace.readthedocs.io/.
     """
+    from brainspace import gradient  # pylint: disable=import-outside-toplevel
+
     logger.info("Computing connectivity matrix...")
-    connectivity_matrix = _get_connectivity_matrix(files, parcellation_file)
+    files_iterator = iter(files)
+    first_file = next(files_iterator, None)
+    if first_file is not None:
+        files_iterator = itertools.chain([first_file], files_iterator)
+    is_volumetric = first_file is not None and str(first_file).endswith(
+        utils.VOLUMETRIC_SUFFIXES
+    )
+    loader = _load_nifti if is_volumetric else _load_gifti
+    connectivity_matrix = _get_connectivity_matrix(
+        files_iterator, loader, parcellation_file, n_jobs=n_jobs
+    )
 
     logger.info("Computing gradients...")
     gradient_map = gradient.GradientMaps(
@@ -64,89 +86,263 @@ def compute_gradients(
 
 
 def _get_connectivity_matrix(
-    files: abc.Collection[str | pathlib.Path],
+    files: abc.Iterable[str | pathlib.Path],
+    loader: abc.Callable[[str | pathlib.Path], np.ndarray],
     parcellation_file: str | pathlib.Path | None = None,
+    n_jobs: int = 1,
 ) -> np.ndarray:
     """
     Computes the connectivity matrix for a collection of files.
 
+    The connectivity matrix is the Fisher z-transformed average of the
+    per-file correlation matrices, i.e. tanh(mean(arctanh(r))). Each file's
+    correlation matrix is computed with a single matrix product of its
+    standardized timeseries. Per-file computations run in single precision,
+    whereas the sum over files is accumulated in double precision. Files are
+    loaded and reduced concurrently in a thread pool; both file decompression
+    and matrix multiplication release the GIL. Each worker thread reuses a
+    single buffer for its per-file correlation matrix.
+    Files are submitted to the pool as it frees up, such that at most twice
+    as many files as there are workers are in flight at any time.
+
     Args:
-        files: A collection of file paths containing timeseries data.
+        files: An iterable of file paths containing timeseries data.
+        loader: The function used to load the files, i.e. `_load_nifti` or
+            `_load_gifti`.
         parcellation_file: A file path containing parcellation data. If None,
             the timeseries data is not parcellated.
+        n_jobs: The number of files to process concurrently.
     Returns:
         A connectivity matrix as a numpy array.
     """
-    if not files:
-        raise ValueError("No files provided.")
-
     if parcellation_file:
         logger.debug("Loading parcellation data...")
-        parcellation = nib.load(parcellation_file)
-        parcellation_data = _get_nifti_gifti_data(parcellation).flatten()
+        parcellation_matrix = _get_parcellation_matrix(
+            _load_parcellation(parcellation_file)
+        )
     else:
-        parcellation_data = None
+        parcellation_matrix = None
+
+    z_sum: np.ndarray | None = None
+    n_files = 0
+    lock = threading.Lock()
+    thread_data = threading.local()
+    epsilon = np.finfo(np.float32).eps
+
+    def accumulate(index: int, filename: str | pathlib.Path) -> None:
+        nonlocal z_sum, n_files
+        logger.debug("Processing file %s...", index + 1)
+        file_z = _get_correlation_matrix(
+            filename,
+            loader,
+            parcellation_matrix,
+            out=getattr(thread_data, "buffer", None),
+        )
+        thread_data.buffer = file_z
+        # Rounding can put the single precision diagonal slightly above 1,
+        # which has no Fisher z-transform.
+        np.clip(file_z, -1 + epsilon, 1 - epsilon, out=file_z)
+        np.arctanh(file_z, out=file_z)
+        with lock:
+            if z_sum is None:
+                z_sum = file_z.astype(np.float64)
+            else:
+                z_sum += file_z
+            n_files += 1
+
+    with futures.ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        pending: set[futures.Future[None]] = set()
+        try:
+            for index, filename in enumerate(files):
+                if len(pending) >= 2 * n_jobs:
+                    done, pending = futures.wait(
+                        pending, return_when=futures.FIRST_COMPLETED
+                    )
+                    for job in done:
+                        job.result()
+                pending.add(pool.submit(accumulate, index, filename))
+            for job in futures.as_completed(pending):
+                job.result()
+        except BaseException:
+            # Do not process the queued files once one of them has failed.
+            pool.shutdown(wait=True, cancel_futures=True)
+            raise
+
+    if z_sum is None:
+        raise ValueError("No files provided.")
+
+    z_sum /= n_files
+    connectivity_matrix = np.tanh(z_sum, out=z_sum)
+    diagonal = np.diagonal(connectivity_matrix)
+    np.fill_diagonal(connectivity_matrix, np.where(np.isnan(diagonal), np.nan, 1.0))
+    return connectivity_matrix
+
+
+def _get_correlation_matrix(
+    filename: str | pathlib.Path,
+    loader: abc.Callable[[str | pathlib.Path], np.ndarray],
+    parcellation_matrix: "sparse.csr_matrix | None",
+    out: np.ndarray | None = None,
+) -> np.ndarray:
+    """Computes the Pearson correlation matrix of the timeseries of a file.
 
-    for index, filename in enumerate(files):
-        logger.debug("Processing file %s of %s...", index + 1, len(files))
-        timeseries = _get_nifti_gifti_data(nib.load(filename)).squeeze()
+    The timeseries are standardized per region, i.e. centered on their mean
+    and divided by the square root of their sum of squares, such that the
+    correlation matrix is their cross-product. The computation runs in single
+    precision; callers should accumulate the results in double precision.
 
-        timeseries_permuted = np.swapaxes(timeseries, 0, -1)
-        timeseries_2d = timeseries_permuted.reshape(timeseries_permuted.shape[0], -1)
+    Args:
+        filename: A file path containing timeseries data.
+        loader: The function used to load the file.
+        parcellation_matrix: Region-by-parcel averaging matrix. If None, the
+            timeseries data is not parcellated.
+        out: A float32 array to write the correlation matrix to. It is only
+            used if its shape matches the number of regions; otherwise a new
+            array is allocated.
 
-        if parcellation_data is not None:
-            timeseries_2d = _parcellate_timeseries(timeseries_2d, parcellation_data)
+    Returns:
+        The region-by-region correlation matrix of the timeseries.
+    """
+    timeseries = loader(filename).squeeze()
 
-        correlation_matrix = np.corrcoef(timeseries_2d, rowvar=False)
-        z_matrix = np.arctanh(correlation_matrix)
+    # NIfTI data is stored in Fortran order, so flattening the spatial
+    # dimensions in Fortran order is a view rather than a copy. Parcellations
+    # are flattened in the same order.
+    timeseries_2d = timeseries.reshape(-1, timeseries.shape[-1], order="F").T
 
-        if index == 0:
-            group_z_matrix = z_matrix / len(files)
-        else:
-            group_z_matrix += z_matrix / len(files)
+    if parcellation_matrix is not None:
+        timeseries_2d = _parcellate_timeseries(timeseries_2d, parcellation_matrix)
 
-    return np.tanh(group_z_matrix)
+    timeseries_2d = np.asarray(timeseries_2d, dtype=np.float32)
+    timeseries_standardized = timeseries_2d - timeseries_2d.mean(axis=0)
+    timeseries_standardized /= np.sqrt(
+        np.einsum("ij,ij->j", timeseries_standardized, timeseries_standardized)
+    )
+
+    n_regions = timeseries_standardized.shape[1]
+    if out is None or out.shape != (n_regions, n_regions):
+        out = np.empty((n_regions, n_regions), dtype=np.float32)
+    return np.matmul(timeseries_standardized.T, timeseries_standardized, out=out)
 
 
 def _parcellate_timeseries(
-    timeseries: npt.ArrayLike, parcellation: npt.ArrayLike
+    timeseries: npt.ArrayLike, parcellation_matrix: "sparse.csr_matrix"
 ) -> np.ndarray:
     """Parcellate timeseries.
 
     Args:
         timeseries: Timeseries data in a time-by-region 2D array.
-        parcellation: Parcellation data in a 1D vector.
+        parcellation_matrix: Region-by-parcel averaging matrix, as returned by
+            `_get_parcellation_matrix`.
 
     Returns:
         Parcellated timeseries into a time-by-parcel 2D array.
     """
     logger.debug("Parcellating timeseries...")
 
-    if np.shape(timeseries)[1] != np.size(parcellation):
+    if np.shape(timeseries)[1] != parcellation_matrix.shape[0]:
         raise exceptions.InputError(
             "Parcellation dimensions do not match timeseries dimensions."
         )
 
-    parcellated_timeseries = brainspace_parcellation.reduce_by_labels(
-        np.array(timeseries), np.array(parcellation)
+    return np.asarray(timeseries, dtype=np.float32) @ parcellation_matrix
+
+
+def _get_parcellation_matrix(parcellation: npt.ArrayLike) -> "sparse.csr_matrix":
+    """Builds a sparse matrix that averages regions within each parcel.
+
+    Multiplying a time-by-region timeseries with this matrix yields the
+    time-by-parcel mean timeseries, with parcels in ascending label order.
+
+    Args:
+        parcellation: Parcellation data. Multi-dimensional data is flattened
+            in Fortran order, matching the flattening of the timeseries.
+
+    Returns:
+        A region-by-parcel sparse matrix. Element (i, j) is the reciprocal of
+        the size of parcel j if region i belongs to parcel j, and 0 otherwise.
+    """
+    from scipy import sparse  # pylint: disable=import-outside-toplevel
+
+    labels = np.ravel(parcellation, order="F")
+    _, parcel_index, parcel_size = np.unique(
+        labels, return_inverse=True, return_counts=True
+    )
+    weights = (1 / parcel_size[parcel_index]).astype(np.float32)
+    return sparse.csr_matrix(
+        (weights, (np.arange(labels.size), parcel_index)),
+        shape=(labels.size, parcel_size.size),
     )
 
-    return parcellated_timeseries
 
+def _load_nifti(
+    filename: str | pathlib.Path, dtype: npt.DTypeLike = np.float32
+) -> np.ndarray:
+    """Loads the data of a NIfTI file.
 
-def _get_nifti_gifti_data(image: filebasedimages.FileBasedImage) -> np.ndarray:
-    """Get the data from a NIfTI or GIFTI image.
+    The data is read straight from the (memory-mapped) array proxy rather
+    than through `get_fdata`, which caches a float64 copy of the full image on
+    the image object.
 
     Args:
-        image: A NIfTI or GIFTI image.
+        filename: The path to the NIfTI file.
+        dtype: The data type of the returned array. If None, the data is
+            returned in its stored data type.
 
     Returns:
         The image data as a numpy array.
+
+    Raises:
+        InputError: If the file is not a NIfTI image, e.g. a CIFTI file.
+    """
+    import nibabel as nib  # pylint: disable=import-outside-toplevel
+
+    logger.debug("Loading NIfTI data...")
+    image = nib.load(filename, mmap=True)
+    if not isinstance(image, nib.Nifti1Image):
+        raise exceptions.InputError(f"{filename} is not a NIfTI image.")
+    return np.asarray(image.dataobj, dtype=dtype)
+
+
+def _load_gifti(
+    filename: str | pathlib.Path, dtype: npt.DTypeLike = np.float32
+) -> np.ndarray:
+    """Loads the data of the first data array of a GIFTI file.
+
+    Args:
+        filename: The path to the GIFTI file.
+        dtype: The data type of the returned array. If None, the data is
+            returned in its stored data type.
+
+    Returns:
+        The image data as a numpy array.
+
+    Raises:
+        InputError: If the file is not a GIFTI image.
+    """
+    import nibabel as nib  # pylint: disable=import-outside-toplevel
+
+    logger.debug("Loading GIFTI data...")
+    image = nib.load(filename, mmap=True)
+    if not isinstance(image, nib.GiftiImage):
+        raise exceptions.InputError(f"{filename} is not a GIFTI image.")
+    return np.asarray(image.darrays[0].data, dtype=dtype)
+
+
+def _load_parcellation(filename: str | pathlib.Path) -> np.ndarray:
+    """Loads a parcellation, with the loader that matches its file suffix.
+
+    The parcellation is loaded independently of the timeseries, such that a
+    parcellation of the wrong type is reported as a dimension mismatch. Labels
+    are kept in their stored data type, as float32 cannot represent every
+    integer label exactly.
+
+    Args:
+        filename: The path to the NIfTI or GIFTI parcellation file.
+
+    Returns:
+        The parcellation data as a numpy array of its stored data type.
     """
-    if isinstance(image, nib.Nifti1Image):
-        logger.debug("Loading NIfTI data...")
-        return image.get_fdata()
-    if isinstance(image, nib.GiftiImage):
-        logger.debug("Loading GIFTI data...")
-        return image.darrays[0].data
-    raise exceptions.InputError("Input image must be a NIfTI or GIFTI image.")
+    if str(filename).endswith(utils.VOLUMETRIC_SUFFIXES):
+        return _load_nifti(filename, dtype=None)
+    return _load_gifti(filename, dtype=None)
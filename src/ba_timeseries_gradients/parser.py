@@ -12,7 +12,8 @@ def get_parser() -> argparse.ArgumentParser:
 
     Notes:
         Arguments in the bids_group must have a `dest` value equivalent to `bids_<argument>`, where
-        <argument> is the name of the argument in the BIDS specification.
+        <argument> is the name of the argument in the BIDS specification, and must be listed in
+        `cli.BIDS_ARGUMENTS`.
     """
     parser = argparse.ArgumentParser(
         prog="ba_timeseries_gradients",
@@ -49,18 +50,20 @@ def get_parser() -> argparse.ArgumentParser:
         required=False,
         default=None,
         type=str,
-        action="append",
+        nargs="+",
+        action="extend",
         dest="bids_subject",
-        help="The subject regex to use for searching BIDS files.",
+        help="The subject regexes to use for searching BIDS files, may be supplied multiple times.",
     )
     bids_group.add_argument(
         "--session",
         required=False,
         default=None,
         type=str,
-        action="append",
+        nargs="+",
+        action="extend",
         dest="bids_session",
-        help="The session to include for finding BIDS files.",
+        help="The sessions to include for finding BIDS files, may be supplied multiple times.",
     )
     bids_group.add_argument(
         "--suffix",
@@ -75,7 +78,8 @@ def get_parser() -> argparse.ArgumentParser:
         required=False,
         default=None,
         type=str,
-        action="append",
+        nargs="+",
+        action="extend",
         dest="bids_run",
         help="The runs to include, may be supplied multiple times.",
     )
@@ -84,7 +88,8 @@ def get_parser() -> argparse.ArgumentParser:
         required=False,
         default=None,
         type=str,
-        action="append",
+        nargs="+",
+        action="extend",
         dest="bids_task",
         help="The tasks to include, may be supplied multiple times.",
     )
@@ -154,6 +159,26 @@ def get_parser() -> argparse.ArgumentParser:
         action="store_true",
         help="Force overwrite of output file if it already exists.",
     )
+    other_group.add_argument(
+        "--layout_cache",
+        required=False,
+        default=None,
+        type=pathlib.Path,
+        help="Directory in which to store the BIDS index for reuse in subsequent runs. If the directory already contains an index of the same BIDS directory, it is loaded instead of re-indexing; an index of a different BIDS directory is overwritten. Remove the directory to force re-indexing, e.g. after files were added to the dataset.",
+    )
+    other_group.add_argument(
+        "--no_bids_index",
+        required=False,
+        action="store_true",
+        help="Find BIDS files by matching filenames instead of indexing the BIDS directory with pybids. Faster for large datasets, but only supports filtering on the BIDS arguments of this CLI.",
+    )
+    other_group.add_argument(
+        "--n_jobs",
+        required=False,
+        default=1,
+        type=_is_positive_integer,
+        help="Number of input files to process concurrently. Each concurrent file is held in memory together with a region-by-region matrix, and uses its own BLAS threads; raise this only if memory allows and reading the files is the bottleneck.",
+    )
     other_group.add_argument(
         "--verbose",
         required=False,
@@ -167,8 +192,8 @@ def get_parser() -> argparse.ArgumentParser:
         required=False,
         default="h5",
         type=str,
-        help="Output file format",
-        choices=["h5", "json"],
+        help="Output file format. The msgpack format requires the msgpack package.",
+        choices=["h5", "json", "msgpack"],
     )
     other_group.add_argument(
         "--dry-run",
@@ -204,8 +229,9 @@ def _is_between_zero_and_one(val: str) -> float:
     Returns:
         float: The argument as a float if it is between 0 (inclusive) and 1 (exclusive).
     """
-    if 0 <= float(val) < 1:
-        return float(val)
+    number = float(val)
+    if 0 <= number < 1:
+        return number
     raise argparse.ArgumentTypeError(f"{val} is not in range [0, 1).")
 
 
@@ -213,11 +239,17 @@ def _is_positive_integer(value: str) -> int:
     """Checks if an argument is greater than 0.
 
     Args:
-        val: The argument to check.
+        value: The argument to check.
 
     Returns:
-        float: The argument as a float if it is greater than 0.
+        int: The argument as an integer if it is greater than 0.
     """
-    if value.isdigit() and int(value) > 0:
-        return int(value)
+    try:
+        number = int(value)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(
+            "Argument is not a positive integer."
+        ) from error
+    if number > 0:
+        return number
     raise argparse.ArgumentTypeError("Argument is not a positive integer.")
@@ -1,17 +1,25 @@
 """ Utility functions for the BrainSpace runner. """
-import json
+import contextlib
+import os
 import pathlib
-
-import h5py
-import numpy as np
+from collections import abc
+from typing import TYPE_CHECKING, BinaryIO
 
 from ba_timeseries_gradients import exceptions
 
+if TYPE_CHECKING:
+    import numpy as np
+    from numpy import typing as npt
+
+VOLUMETRIC_SUFFIXES = (".nii", ".nii.gz")
+SURFACE_SUFFIXES = (".gii",)
+
 
 def save(
-    output_gradients: np.ndarray,
-    lambdas: np.ndarray,
+    output_gradients: "np.ndarray",
+    lambdas: "np.ndarray",
     filename: str | pathlib.Path,
+    dtype: "npt.DTypeLike" = "float32",
 ) -> None:
     """
     Saves a numpy array to a file with the given filename.
@@ -19,51 +27,159 @@ def save(
     Args:
         output_gradients: The numpy array to save.
         lambdas: The lambdas to save.
-        lambdas: The lambdas to save.
         filename: The filename to save the array to.
+        dtype: The data type to store the arrays as. Single precision halves
+            the output size relative to the double precision produced by
+            BrainSpace.
 
     """
+    output_gradients = output_gradients.astype(dtype, copy=False)
+    lambdas = lambdas.astype(dtype, copy=False)
+    writers = {".h5": save_hdf5, ".json": save_json, ".msgpack": save_msgpack}
     filename = pathlib.Path(filename)
-    if filename.suffix == ".h5":
-        save_hdf5(output_gradients, lambdas, filename)
-    elif filename.suffix == ".json":
-        save_json(output_gradients, lambdas, filename)
-    else:
+    writer = writers.get(filename.suffix)
+    if writer is None:
         raise exceptions.InternalError(f"Unsupported file type: {filename}")
+    writer(output_gradients, lambdas, filename)
 
 
 def save_hdf5(
-    output_gradients: np.ndarray, lambdas: np.ndarray, filename: str | pathlib.Path
+    output_gradients: "np.ndarray",
+    lambdas: "np.ndarray",
+    filename: str | pathlib.Path | BinaryIO,
 ) -> None:
     """
-    Saves a numpy array to a HDF5 file with the given filename.
+    Saves a numpy array to a HDF5 file with the given filename or to a
+    binary file object.
+
+    The gradients are stored in byte-shuffled, LZF-compressed chunks of at
+    most 1024 rows, using the latest HDF5 file format. The file is opened
+    without HDF5 file locking as it is written by a single process.
 
     Args:
         output_gradients: The numpy array to save.
-        filename: The filename to save the array to.
+        filename: The filename or binary file object to save the array to.
 
     """
-    with h5py.File(filename, "w") as h5_file:
-        h5_file.create_dataset("gradients", data=output_gradients)
+    import h5py  # pylint: disable=import-outside-toplevel
+
+    chunks = (min(1024, output_gradients.shape[0]), *output_gradients.shape[1:])
+    with h5py.File(
+        filename, "w", libver="latest", locking=False, track_order=False
+    ) as h5_file:
+        h5_file.create_dataset(
+            "gradients",
+            data=output_gradients,
+            chunks=chunks,
+            compression="lzf",
+            shuffle=True,
+        )
         h5_file.create_dataset("lambdas", data=lambdas)
 
 
 def save_json(
-    output_gradients: np.ndarray, lambdas: np.ndarray, filename: str | pathlib.Path
+    output_gradients: "np.ndarray",
+    lambdas: "np.ndarray",
+    filename: str | pathlib.Path | BinaryIO,
 ) -> None:
     """
-    Saves a numpy array to a JSON file with the given filename.
+    Saves a numpy array to a JSON file with the given filename or to a
+    binary file object.
+
+    The gradients are written one row at a time, such that only a single row
+    is ever held in memory as JSON. Rows are serialized with orjson if it is
+    installed, and with the standard library JSON encoder otherwise. With
+    either encoder, non-finite values, e.g. of disconnected regions, are
+    written as null, as JSON has no representation for them.
 
     Args:
         output_gradients: The numpy array to save.
-        filename: The filename to save the array to.
+        filename: The filename or binary file object to save the array to.
 
     """
-    with open(filename, "w", encoding="utf-8") as file_buffer:
-        json.dump(
-            {
-                "gradients": output_gradients.tolist(),
-                "lambdas": lambdas.tolist(),
-            },
-            file_buffer,
+    import numpy as np  # pylint: disable=import-outside-toplevel
+
+    try:
+        import orjson  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        import json  # pylint: disable=import-outside-toplevel
+
+        def dumps(array: "np.ndarray") -> bytes:
+            array = np.asarray(array)
+            values = array.astype(object)
+            values[~np.isfinite(array)] = None
+            return json.dumps(values.tolist(), allow_nan=False).encode("utf-8")
+
+    else:
+
+        def dumps(array: "np.ndarray") -> bytes:
+            return orjson.dumps(array, option=orjson.OPT_SERIALIZE_NUMPY)
+
+    output_gradients = np.ascontiguousarray(output_gradients)
+    with _open_binary(filename) as file_buffer:
+        file_buffer.write(b'{"gradients": [')
+        for index, row in enumerate(output_gradients):
+            if index:
+                file_buffer.write(b", ")
+            file_buffer.write(dumps(row))
+        file_buffer.write(b'], "lambdas": ')
+        file_buffer.write(dumps(np.ascontiguousarray(lambdas)))
+        file_buffer.write(b"}")
+
+
+def save_msgpack(
+    output_gradients: "np.ndarray",
+    lambdas: "np.ndarray",
+    filename: str | pathlib.Path | BinaryIO,
+) -> None:
+    """
+    Saves a numpy array to a MessagePack file with the given filename or to a
+    binary file object.
+
+    Each array is stored as a map with its "shape", "dtype" and raw C-ordered
+    "data" bytes, such that it can be restored with e.g.
+    `numpy.frombuffer(data, dtype).reshape(shape)`.
+
+    Args:
+        output_gradients: The numpy array to save.
+        lambdas: The lambdas to save.
+        filename: The filename or binary file object to save the array to.
+
+    """
+    import msgpack  # pylint: disable=import-outside-toplevel
+    import numpy as np  # pylint: disable=import-outside-toplevel
+
+    def pack(array: "np.ndarray") -> dict[str, object]:
+        array = np.ascontiguousarray(array)
+        return {
+            "shape": list(array.shape),
+            "dtype": array.dtype.str,
+            "data": array.data.cast("B"),
+        }
+
+    with _open_binary(filename) as file_buffer:
+        file_buffer.write(
+            msgpack.packb(
+                {"gradients": pack(output_gradients), "lambdas": pack(lambdas)}
+            )
         )
+
+
+@contextlib.contextmanager
+def _open_binary(
+    file: str | pathlib.Path | BinaryIO,
+) -> abc.Iterator[BinaryIO]:
+    """Opens a file for binary writing, unless it is already a file object.
+
+    Args:
+        file: A filename or a binary file object. File objects are neither
+            reopened nor closed.
+
+    Yields:
+        The binary file object to write to.
+    """
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, "wb") as file_buffer:
+            yield file_buffer
+    else:
+        yield file
@@ -40,6 +40,7 @@ class MockParser:
     sparsity: float = 0.1
     n_components: int = 10
     force: bool = False
+    n_jobs: int = 1
     verbose: str = "info"
     dry_run: bool = False
 
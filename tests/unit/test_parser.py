@@ -32,22 +32,12 @@ def test_is_positive_integer_success() -> None:
     assert parser._is_positive_integer("1") == 1
 
 
-def test_is_positive_integer_failure_not_int() -> None:
-    """Test the _is_positive_integer function for a float."""
+@pytest.mark.parametrize("value", ["0.5", "-1", "0"])
+def test_is_positive_integer_failure(value: str) -> None:
+    """Test the _is_positive_integer function for a float, a negative integer
+    and zero."""
     with pytest.raises(argparse.ArgumentTypeError):
-        parser._is_positive_integer("0.5")
-
-
-def test_is_positive_integer_failure_negative() -> None:
-    """Test the _is_positive_integer function for a negative integer."""
-    with pytest.raises(argparse.ArgumentTypeError):
-        parser._is_positive_integer("-1")
-
-
-def test_is_positive_integer_failure_zero() -> None:
-    """Test the _is_positive_integer function for zero."""
-    with pytest.raises(argparse.ArgumentTypeError):
-        parser._is_positive_integer("0")
+        parser._is_positive_integer(value)
 
 
 def test_is_between_zero_and_one_success() -> None:
@@ -55,13 +45,25 @@ def test_is_between_zero_and_one_success() -> None:
     assert parser._is_between_zero_and_one("0") == 0
 
 
-def test_is_between_zero_and_one_failure_is_one() -> None:
-    """Test the _is_between_zero_and_one function for a failure case."""
+@pytest.mark.parametrize("value", ["1", "-1"])
+def test_is_between_zero_and_one_failure(value: str) -> None:
+    """Test the _is_between_zero_and_one function for values outside [0, 1)."""
     with pytest.raises(argparse.ArgumentTypeError):
-        parser._is_between_zero_and_one("1")
-
+        parser._is_between_zero_and_one(value)
+
+
+@pytest.mark.parametrize(
+    "arguments",
+    [
+        ["--run", "1", "2", "--task", "rest"],
+        ["--run", "1", "--run", "2", "--task", "rest"],
+    ],
+)
+def test_get_parser_multiple_values(arguments: list[str]) -> None:
+    """Test that multi-valued BIDS arguments accept both several values per flag
+    and repeated flags."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        args = parser.get_parser().parse_args([temp_dir, "output", "group", *arguments])
 
-def test_is_between_zero_and_one_failure_is_negative() -> None:
-    """Test the _is_between_zero_and_one function for a failure case."""
-    with pytest.raises(argparse.ArgumentTypeError):
-        parser._is_between_zero_and_one("-1")
+    assert args.bids_run == ["1", "2"]
+    assert args.bids_task == ["rest"]
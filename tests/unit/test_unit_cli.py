@@ -3,35 +3,45 @@
 # pylint: disable=protected-access
 
 import argparse
+import copy
 import logging
+import os
 import pathlib
+import subprocess
+import sys
 from unittest import mock
 
 import pytest
+import pytest_mock
 
-from ba_timeseries_gradients import cli, exceptions
+from ba_timeseries_gradients import cli, exceptions, parser
+
+MOCK_ARGS = argparse.Namespace(
+    verbose=logging.INFO,
+    parcellation="test.nii.gz",
+    output_dir=pathlib.Path("/path/to/output"),
+    bids_dir=pathlib.Path("/path/to/bids"),
+    force=False,
+    output_format="h5",
+    layout_cache=None,
+    no_bids_index=False,
+)
 
 
 @pytest.fixture
-def mock_args() -> mock.MagicMock:
-    """Returns a mock argparse.Namespace object with default values for testing purposes.
+def mock_args() -> argparse.Namespace:
+    """Returns an argparse.Namespace object with default values for testing purposes.
 
     Returns:
-        mock.MagicMock: A mock argparse.Namespace object.
+        argparse.Namespace: A copy of MOCK_ARGS, which tests may modify.
     """
-    args = mock.MagicMock(spec=argparse.Namespace)
-    args.verbose = logging.INFO
-    args.parcellation = "test.nii.gz"
-    args.output_dir = pathlib.Path("/path/to/output")
-    args.bids_dir = pathlib.Path("/path/to/bids")
-    args.force = False
-    args.output_format = "hdf5"
-    return args
+    return copy.copy(MOCK_ARGS)
 
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 def mock_files() -> list[str]:
-    """Returns a list of mock file paths for testing purposes.
+    """Returns a list of mock file paths for testing purposes. The list is shared
+    across the module and must not be modified.
 
     Returns:
         list[str]: A list of mock file paths.
@@ -39,11 +49,24 @@ def mock_files() -> list[str]:
     return ["/path/to/bids/sub-01/func/sub-01_task-rest_bold.nii.gz"]
 
 
-def test_raise_invalid_input_existing_output_file(mock_args: mock.MagicMock) -> None:
+@pytest.fixture
+def logger_error_spy(mocker: pytest_mock.MockerFixture) -> mock.MagicMock:
+    """Returns a spy on the error method of the CLI logger.
+
+    Returns:
+        mock.MagicMock: The spy on `cli.logger.error`.
+    """
+    return mocker.spy(cli.logger, "error")
+
+
+@pytest.mark.parametrize("output_format", ["h5", "json", "msgpack"])
+def test_raise_invalid_input_existing_output_file(
+    mock_args: argparse.Namespace, tmp_path: pathlib.Path, output_format: str
+) -> None:
     """Test _raise_invalid_input when output file already exists."""
-    mock_output_file = mock.MagicMock()
-    mock_output_file.exists.return_value = True
-    mock_args.output_dir = mock_output_file
+    (tmp_path / f"gradients.{output_format}").touch()
+    mock_args.output_dir = tmp_path
+    mock_args.output_format = output_format
 
     with pytest.raises(exceptions.InputError) as exc_info:
         cli._raise_invalid_input(mock_args, [])
@@ -51,21 +74,214 @@ def test_raise_invalid_input_existing_output_file(mock_args: mock.MagicMock) ->
     assert "Output file already exists" in str(exc_info.value)
 
 
-def test_raise_invalid_input_no_input_files(mock_args: mock.MagicMock) -> None:
-    """Test _raise_invalid_input when no input files are provided."""
+@pytest.mark.parametrize(
+    ("files", "parcellation", "message"),
+    [
+        ([], "test.nii.gz", "No input files found"),
+        (
+            ["/path/to/bids/sub-01/func/sub-01_task-rest_bold.nii.gz"],
+            None,
+            "Must provide a parcellation",
+        ),
+        (
+            ["sub-01_bold.nii.gz", "sub-02_bold.func.gii"],
+            "test.nii.gz",
+            "all NIfTI or all GIFTI",
+        ),
+        (
+            ["sub-01_bold.nii.gz", "sub-01_bold.json"],
+            "test.nii.gz",
+            "all NIfTI or all GIFTI",
+        ),
+        (
+            ["sub-01_bold.nii.gz"],
+            "parcellation.txt",
+            "Parcellation must be a NIfTI or GIFTI file",
+        ),
+    ],
+)
+def test_raise_invalid_input(
+    mock_args: argparse.Namespace,
+    files: list[str],
+    parcellation: str | None,
+    message: str,
+) -> None:
+    """Test _raise_invalid_input for invalid input files and parcellations."""
+    mock_args.parcellation = parcellation
+
     with pytest.raises(exceptions.InputError) as exc_info:
-        cli._raise_invalid_input(mock_args, [])
+        cli._raise_invalid_input(mock_args, files)
 
-    assert "No input files found" in str(exc_info.value)
+    assert message in str(exc_info.value)
 
 
-def test_raise_invalid_input_no_parcellation(
-    mock_args: mock.MagicMock, mock_files: list[str]
+def test_raise_invalid_input_missing_msgpack(
+    mocker: pytest_mock.MockerFixture,
+    mock_args: argparse.Namespace,
+    mock_files: list[str],
 ) -> None:
-    """Test _raise_invalid_input when no parcellation is provided."""
-    mock_args.parcellation = None
+    """Test _raise_invalid_input when msgpack output is requested but msgpack is
+    not installed."""
+    mocker.patch("importlib.util.find_spec", return_value=None)
+    mock_args.output_format = "msgpack"
 
     with pytest.raises(exceptions.InputError) as exc_info:
         cli._raise_invalid_input(mock_args, mock_files)
 
-    assert "Must provide a parcellation" in str(exc_info.value)
+    assert "requires the msgpack package" in str(exc_info.value)
+
+
+def test_get_bids_files_layout_cache(
+    mocker: pytest_mock.MockerFixture, mock_args: argparse.Namespace
+) -> None:
+    """Test that _get_bids_files passes the layout cache to pybids."""
+    mock_layout = mocker.patch("bids.BIDSLayout")
+    mock_layout.return_value.get.return_value = ["file1"]
+    mock_layout.return_value.root = str(mock_args.bids_dir)
+    mock_args.layout_cache = pathlib.Path("/path/to/cache")
+    for argument in cli.BIDS_ARGUMENTS:
+        setattr(mock_args, argument, None)
+    mock_args.bids_suffix = "bold"
+
+    actual = cli._get_bids_files(mock_args)
+
+    assert actual == ["file1"]
+    mock_layout.assert_called_once_with(
+        mock_args.bids_dir,
+        validate=False,
+        database_path=mock_args.layout_cache,
+        reset_database=False,
+        indexer=mock.ANY,
+    )
+    mock_layout.return_value.get.assert_called_once_with(
+        return_type="filename", suffix="bold"
+    )
+
+
+def test_get_bids_files_layout_cache_other_dataset(
+    mock_args: argparse.Namespace, tmp_path: pathlib.Path
+) -> None:
+    """Test that a layout cache of another BIDS directory is not reused."""
+    for dataset in ("ds", "ds2"):
+        func_dir = tmp_path / dataset / "sub-01" / "func"
+        func_dir.mkdir(parents=True)
+        (tmp_path / dataset / "dataset_description.json").write_text(
+            '{"Name": "test", "BIDSVersion": "1.8.0"}'
+        )
+        (func_dir / "sub-01_task-rest_bold.nii.gz").touch()
+    for argument in cli.BIDS_ARGUMENTS:
+        setattr(mock_args, argument, None)
+    mock_args.bids_suffix = "bold"
+    mock_args.layout_cache = tmp_path / "cache"
+
+    mock_args.bids_dir = tmp_path / "ds"
+    cli._get_bids_files(mock_args)
+    mock_args.bids_dir = tmp_path / "ds2"
+    actual = cli._get_bids_files(mock_args)
+
+    assert actual == [
+        str(tmp_path / "ds2" / "sub-01" / "func" / "sub-01_task-rest_bold.nii.gz")
+    ]
+
+
+@pytest.mark.parametrize(
+    "search_args,expected",
+    [
+        (
+            {"suffix": "bold", "extension": ".nii.gz"},
+            [
+                "sub-01/func/sub-01_task-rest_run-01_bold.nii.gz",
+                "sub-01/ses-1/func/sub-01_ses-1_task-rest_bold.nii.gz",
+                "sub-02/func/sub-02_task-nback_bold.nii.gz",
+            ],
+        ),
+        (
+            {"subject": ["02"], "suffix": "bold", "extension": "nii.gz"},
+            ["sub-02/func/sub-02_task-nback_bold.nii.gz"],
+        ),
+        (
+            {"run": ["1"], "task": ["rest"], "suffix": "bold"},
+            [
+                "sub-01/func/sub-01_task-rest_run-01_bold.json",
+                "sub-01/func/sub-01_task-rest_run-01_bold.nii.gz",
+            ],
+        ),
+        (
+            {"session": ["1"], "datatype": "func", "suffix": "bold"},
+            ["sub-01/ses-1/func/sub-01_ses-1_task-rest_bold.nii.gz"],
+        ),
+        ({"space": "MNI", "suffix": "bold"}, []),
+    ],
+)
+def test_glob_bids_files(
+    tmp_path: pathlib.Path,
+    search_args: dict[str, str | list[str]],
+    expected: list[str],
+) -> None:
+    """Test that _glob_bids_files filters BIDS filenames on their entities."""
+    for filename in [
+        "sub-01/func/sub-01_task-rest_run-01_bold.nii.gz",
+        "sub-01/func/sub-01_task-rest_run-01_bold.json",
+        "sub-01/ses-1/func/sub-01_ses-1_task-rest_bold.nii.gz",
+        "sub-01/anat/sub-01_T1w.nii.gz",
+        "sub-02/func/sub-02_task-nback_bold.nii.gz",
+        "derivatives/sub-01/func/sub-01_task-rest_bold.nii.gz",
+    ]:
+        (tmp_path / filename).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / filename).touch()
+
+    actual = cli._glob_bids_files(tmp_path, search_args)
+
+    assert actual == [str(tmp_path / filename) for filename in expected]
+
+
+def test_bids_arguments_match_parser() -> None:
+    """Test that BIDS_ARGUMENTS lists every BIDS argument of the parser."""
+    dests = {
+        action.dest
+        for action in parser.get_parser()._actions
+        if action.dest.startswith("bids_") and action.dest != "bids_dir"
+    }
+
+    assert dests == set(cli.BIDS_ARGUMENTS)
+
+
+@pytest.mark.parametrize(
+    "exception_type", [exceptions.InputError, exceptions.InternalError]
+)
+def test_main_logs_error_once(
+    mocker: pytest_mock.MockerFixture,
+    mock_args: argparse.Namespace,
+    logger_error_spy: mock.MagicMock,
+    exception_type: type[exceptions.BaseLoggingError],
+) -> None:
+    """Test that main logs a package error once and exits."""
+    mock_args.verbose = "info"
+    mock_parser = mocker.patch("ba_timeseries_gradients.parser.get_parser")
+    mock_parser.return_value.parse_args.return_value = mock_args
+    mocker.patch(
+        "ba_timeseries_gradients.cli._get_bids_files",
+        side_effect=exception_type("Test message"),
+    )
+
+    with pytest.raises(SystemExit) as exc_info:
+        cli.main()
+
+    assert exc_info.value.code == 2
+    logger_error_spy.assert_called_once_with("Test message")
+
+
+def test_import_does_not_load_numpy() -> None:
+    """Test that importing the CLI does not import numpy, such that --help and
+    argument errors are not held up by heavy imports."""
+    code = "import sys, ba_timeseries_gradients.cli; print('numpy' in sys.modules)"
+
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        check=True,
+        env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)},
+        text=True,
+    )
+
+    assert result.stdout.strip() == "False"
@@ -1,6 +1,5 @@
 """ Unit tests for the ba_timeseries_gradients.exceptions module. """
 import pytest
-import pytest_mock
 
 from ba_timeseries_gradients import exceptions
 
@@ -14,15 +13,15 @@ from ba_timeseries_gradients import exceptions
     ],
 )
 def test_logging_error(
-    mocker: pytest_mock.MockFixture,
+    caplog: pytest.LogCaptureFixture,
     exception_type: exceptions.BaseLoggingError | exceptions.InputError,
 ) -> None:
     """
-    Test that a BaseLoggingError is raised with the correct message and that the error is logged.
+    Test that a BaseLoggingError is raised with the correct message and that the error is
+    not logged on construction.
     """
-    spy_error_logger = mocker.spy(exceptions.logger, "error")
-
-    with pytest.raises(exception_type):  # type: ignore[call-overload]
+    with pytest.raises(exception_type) as exc_info:  # type: ignore[call-overload]
         raise exception_type("Test message")  # type: ignore[operator]
 
-    spy_error_logger.assert_called_once_with("Test message")
+    assert exc_info.value.message == "Test message"
+    assert not caplog.records
@@ -1,5 +1,12 @@
 """ Unit tests for the gradients module. """
 # pylint: disable=protected-access
+# pylint: disable=redefined-outer-name
+import pathlib
+import threading
+from concurrent import futures
+from unittest import mock
+
+import nibabel as nib
 import numpy as np
 import pytest
 import pytest_mock
@@ -7,6 +14,17 @@ import pytest_mock
 from ba_timeseries_gradients import exceptions, gradients
 
 
+@pytest.fixture
+def mock_loader(mocker: pytest_mock.MockerFixture) -> mock.Mock:
+    """Returns a mock file loader for `_get_connectivity_matrix`. Tests set the
+    loaded data through its `return_value`.
+
+    Returns:
+        mock.Mock: A mock file loader.
+    """
+    return mocker.Mock()
+
+
 def test_compute_gradients(mocker: pytest_mock.MockFixture) -> None:
     """Test that the compute_gradients function calls the correct functions."""
     mocker.patch(
@@ -20,48 +38,209 @@ def test_compute_gradients(mocker: pytest_mock.MockFixture) -> None:
     assert np.allclose(actual_lambdas, 0)
 
 
-def test_connevtivity_matrix_from_2d_success(mocker: pytest_mock.MockerFixture) -> None:
-    """Test that the connectivity matrix is computed correctly from a 2D
+@pytest.mark.parametrize(
+    ("data", "expected"),
+    [
+        (np.eye(3), np.where(np.eye(3, dtype=bool), 1.0, -0.5)),
+        (
+            np.concatenate((np.ones((2, 2, 2, 2)), np.zeros((2, 2, 2, 1))), axis=3),
+            np.ones((8, 8)),
+        ),
+    ],
+    ids=["2d", "4d"],
+)
+def test_connectivity_matrix_success(
+    mock_loader: mock.Mock, data: np.ndarray, expected: np.ndarray
+) -> None:
+    """Test that the connectivity matrix is computed correctly from 2D and 4D
     timeseries."""
-    mocker.patch("nibabel.load")
-    mocker.patch(
-        "ba_timeseries_gradients.gradients._get_nifti_gifti_data",
-        return_value=np.eye(3),
-    )
-    expected = np.eye(3)
-    expected[~np.eye(3, dtype=bool)] = -0.5
+    mock_loader.return_value = data
 
-    actual = gradients._get_connectivity_matrix(["file1", "file2"])
+    actual = gradients._get_connectivity_matrix(["file1", "file2"], mock_loader)
 
     assert np.allclose(actual, expected)
 
 
-def test_connevtivity_matrix_from_4d_success(mocker: pytest_mock.MockerFixture) -> None:
-    """Test that the connectivity matrix is computed correctly from a 4D
-    timeseries."""
-    data_4d = np.concatenate((np.ones((2, 2, 2, 2)), np.zeros((2, 2, 2, 1))), axis=3)
-    mocker.patch("nibabel.load")
-    mocker.patch(
-        "ba_timeseries_gradients.gradients._get_nifti_gifti_data", return_value=data_4d
-    )
-    expected = np.ones((8, 8))
+def test_connectivity_matrix_matches_corrcoef(mock_loader: mock.Mock) -> None:
+    """Test that the connectivity matrix of a single file is its Pearson
+    correlation matrix."""
+    timeseries = np.random.default_rng(0).random((20, 5))
+    mock_loader.return_value = timeseries.T
+    expected = np.corrcoef(timeseries, rowvar=False)
 
-    actual = gradients._get_connectivity_matrix(["file1", "file2"])
+    actual = gradients._get_connectivity_matrix(["file1"], mock_loader)
 
     assert np.allclose(actual, expected)
 
 
+def test_connectivity_matrix_fisher_z_average(mock_loader: mock.Mock) -> None:
+    """Test that the connectivity matrix is the Fisher z-transformed average of
+    the per-file correlation matrices."""
+    rng = np.random.default_rng(0)
+    timeseries = [rng.random((20, 3)) for _ in range(3)]
+    mock_loader.side_effect = [data.T for data in timeseries]
+    z_matrices = [
+        np.arctanh(np.corrcoef(data, rowvar=False) * (1 - np.eye(3)))
+        for data in timeseries
+    ]
+    expected = np.tanh(np.mean(z_matrices, axis=0)) + np.eye(3)
+
+    actual = gradients._get_connectivity_matrix(["a", "b", "c"], mock_loader)
+
+    assert np.allclose(actual, expected, atol=1e-5)
+
+
+def test_connectivity_matrix_from_generator(mock_loader: mock.Mock) -> None:
+    """Test that the connectivity matrix can be computed from a generator of
+    files, with more files than the number of files kept in flight."""
+    mock_loader.return_value = np.eye(3)
+    files = (f"file{index}" for index in range(5))
+
+    actual = gradients._get_connectivity_matrix(files, mock_loader, n_jobs=1)
+
+    assert np.allclose(actual, np.where(np.eye(3, dtype=bool), 1, -0.5))
+    assert mock_loader.call_count == 5
+
+
+def test_connectivity_matrix_cancels_queued_files(
+    mocker: pytest_mock.MockerFixture, mock_loader: mock.Mock
+) -> None:
+    """Test that queued files are not processed once a file has failed."""
+    release = threading.Event()
+    shutdown = futures.ThreadPoolExecutor.shutdown
+
+    def shutdown_then_release(
+        self: futures.ThreadPoolExecutor,
+        wait: bool = True,
+        *,
+        cancel_futures: bool = False,
+    ) -> None:
+        # Workers stay blocked until the queue has been cancelled, so the
+        # outcome does not depend on thread timing.
+        shutdown(self, wait=False, cancel_futures=cancel_futures)
+        release.set()
+        shutdown(self, wait=wait)
+
+    def load(filename: str) -> np.ndarray:
+        if filename == "file0":
+            raise exceptions.InputError("Test message")
+        release.wait()
+        return np.eye(3)
+
+    mocker.patch.object(futures.ThreadPoolExecutor, "shutdown", shutdown_then_release)
+    mock_loader.side_effect = load
+
+    with pytest.raises(exceptions.InputError):
+        gradients._get_connectivity_matrix(
+            [f"file{index}" for index in range(6)], mock_loader, n_jobs=2
+        )
+
+    loaded = {call.args[0] for call in mock_loader.call_args_list}
+    # file2 may or may not have been taken up by the worker freed by file0
+    # before the queue was cancelled; file3 to file5 are never loaded.
+    assert loaded in ({"file0", "file1"}, {"file0", "file1", "file2"})
+
+
+def test_connectivity_matrix_no_files(mock_loader: mock.Mock) -> None:
+    """Test that an error is raised when no files are provided."""
+    with pytest.raises(ValueError):
+        gradients._get_connectivity_matrix(iter([]), mock_loader)
+
+
+def test_correlation_matrix_volume_parcellation_order(tmp_path: pathlib.Path) -> None:
+    """Test that voxels of a 4D volume are matched to their own parcel."""
+    parcel_timeseries = np.random.default_rng(0).random((24, 10))
+    labels = np.random.default_rng(1).permutation(24).reshape(2, 3, 4)
+    data = parcel_timeseries[labels]
+    nib.save(nib.Nifti1Image(data.astype(np.float32), np.eye(4)), tmp_path / "d.nii")
+    parcellation_matrix = gradients._get_parcellation_matrix(labels)
+    expected = np.corrcoef(parcel_timeseries)
+
+    actual = gradients._get_correlation_matrix(
+        tmp_path / "d.nii", gradients._load_nifti, parcellation_matrix
+    )
+
+    assert np.allclose(actual, expected, atol=1e-5)
+
+
+def test_connectivity_matrix_scale_invariant(mock_loader: mock.Mock) -> None:
+    """Test that rescaling the data of one file does not change the
+    connectivity matrix."""
+    rng = np.random.default_rng(0)
+    timeseries = [rng.random((3, 20)), rng.random((3, 20))]
+    mock_loader.side_effect = timeseries
+    expected = gradients._get_connectivity_matrix(["a", "b"], mock_loader, n_jobs=1)
+    mock_loader.side_effect = [timeseries[0], timeseries[1] * 100]
+
+    actual = gradients._get_connectivity_matrix(["a", "b"], mock_loader, n_jobs=1)
+
+    assert np.allclose(actual, expected, atol=1e-5)
+
+
+def test_load_nifti_rejects_cifti(tmp_path: pathlib.Path) -> None:
+    """Test that a CIFTI file is not read as a NIfTI volume."""
+    brain_models = nib.cifti2.BrainModelAxis.from_mask(
+        np.ones(4, dtype=bool), name="CortexLeft"
+    )
+    series = nib.cifti2.SeriesAxis(start=0, step=1, size=5)
+    image = nib.Cifti2Image(
+        np.zeros((5, 4), dtype=np.float32), header=(series, brain_models)
+    )
+    nib.save(image, tmp_path / "d.dtseries.nii")
+
+    with pytest.raises(exceptions.InputError):
+        gradients._load_nifti(tmp_path / "d.dtseries.nii")
+
+
+def test_connectivity_matrix_gifti_parcellation_for_nifti(
+    tmp_path: pathlib.Path,
+) -> None:
+    """Test that a GIFTI parcellation of NIfTI timeseries raises an input
+    error rather than failing to read the parcellation."""
+    data = np.random.default_rng(0).random((2, 2, 2, 5)).astype(np.float32)
+    nib.save(nib.Nifti1Image(data, np.eye(4)), tmp_path / "d.nii")
+    parcellation = nib.GiftiImage(
+        darrays=[nib.gifti.GiftiDataArray(np.arange(3, dtype=np.int32))]
+    )
+    nib.save(parcellation, tmp_path / "p.label.gii")
+
+    with pytest.raises(exceptions.InputError):
+        gradients._get_connectivity_matrix(
+            [tmp_path / "d.nii"], gradients._load_nifti, tmp_path / "p.label.gii"
+        )
+
+
+@pytest.mark.parametrize("suffix", [".nii", ".label.gii"])
+def test_load_parcellation_keeps_large_labels(
+    tmp_path: pathlib.Path, suffix: str
+) -> None:
+    """Test that labels that float32 cannot tell apart remain distinct
+    parcels."""
+    labels = np.array([2**24, 2**24 + 1, 2**24 + 1], dtype=np.int32)
+    if suffix == ".nii":
+        image = nib.Nifti1Image(labels.reshape(3, 1, 1), np.eye(4))
+    else:
+        image = nib.GiftiImage(darrays=[nib.gifti.GiftiDataArray(labels)])
+    nib.save(image, tmp_path / f"p{suffix}")
+
+    parcellation = gradients._load_parcellation(tmp_path / f"p{suffix}")
+
+    assert np.array_equal(np.ravel(parcellation), labels)
+    assert gradients._get_parcellation_matrix(parcellation).shape == (3, 2)
+
+
 def test_parcellate_2d_timeseries_success() -> None:
     """Test that the 2D timeseries are parcellated correctly."""
-    timeseries = [[1, 2, 1], [1, 1, 1], [2, 2, 2]]
-    parcellation = [1, 1, 2]
+    timeseries = np.array([[1, 2, 1], [1, 1, 1], [2, 2, 2]], dtype=np.float64)
+    parcellation = np.array([1, 1, 2])
     expected = np.array([[1.5, 1], [1, 1], [2, 2]])
 
     actual = gradients._parcellate_timeseries(
         timeseries=timeseries,
-        parcellation=parcellation,
+        parcellation_matrix=gradients._get_parcellation_matrix(parcellation),
     )
 
+    assert not isinstance(actual, np.matrix)
     assert np.allclose(actual, expected)
 
 
@@ -70,6 +249,8 @@ def test_parcellate_timeseries_faulty_dimensions() -> None:
     match the timeseries dimensions."""
     with pytest.raises(exceptions.InputError):
         gradients._parcellate_timeseries(
-            timeseries=[[1, 2, 3], [4, 5, 6]],
-            parcellation=[[1, 2], [3, 4]],
+            timeseries=np.array([[1, 2, 3], [4, 5, 6]]),
+            parcellation_matrix=gradients._get_parcellation_matrix(
+                np.array([[1, 2], [3, 4]])
+            ),
         )
@@ -1,18 +1,17 @@
 """ Unit tests for the utils module. """
 import dataclasses
+import io
 import json
-import os
 import pathlib
-import tempfile
+import sys
 
 import h5py
 import numpy as np
 import pytest
+import pytest_mock
 
 from ba_timeseries_gradients import exceptions, utils
 
-IS_WINDOWS = os.name == "nt"
-
 
 @dataclasses.dataclass
 class MockArgparse:
@@ -22,49 +21,161 @@ class MockArgparse:
     output_format: str
 
 
-@pytest.mark.skipif(
-    IS_WINDOWS,
-    reason="Windows does not support writing to and reading from the same temporary file.",
-)
-def test_save_hdf5() -> None:
-    """Test that the _save_numpy_array function saves a numpy array to an h5 file
-    with the correct name and content.
+@pytest.fixture(scope="module")
+def output_dir(tmp_path_factory: pytest.TempPathFactory) -> pathlib.Path:
+    """Returns a temporary output directory shared by the tests in this module.
+
+    Returns:
+        pathlib.Path: The path to the output directory.
+    """
+    return tmp_path_factory.mktemp("saves")
+
+
+@pytest.fixture(scope="module")
+def expected_gradients() -> np.ndarray:
+    """Returns a gradients array shared by the tests in this module.
+
+    Returns:
+        np.ndarray: A 2x3 gradients array.
+    """
+    return np.array([[1, 2, 3], [4, 5, 6]])
+
+
+@pytest.fixture(scope="module")
+def expected_lambdas() -> np.ndarray:
+    """Returns a lambdas array shared by the tests in this module.
+
+    Returns:
+        np.ndarray: A lambdas array.
+    """
+    return np.array([1, 2, 3])
+
+
+def test_save_hdf5(
+    expected_gradients: np.ndarray, expected_lambdas: np.ndarray
+) -> None:
+    """Test that the save_hdf5 function saves a numpy array to an h5 file
+    with the correct content.
     """
-    expected_1 = np.array([[1, 2, 3], [4, 5, 6]])
-    expected_2 = np.array([1, 2, 3])
+    buffer = io.BytesIO()
 
-    with tempfile.NamedTemporaryFile(suffix=".h5") as f:
-        utils.save_hdf5(expected_1, expected_2, f.name)
-        with h5py.File(f.name, "r") as h5:
-            actual_1 = np.array(h5["gradients"])
-            actual_2 = np.array(h5["lambdas"])
+    utils.save_hdf5(expected_gradients, expected_lambdas, buffer)
+    with h5py.File(buffer, "r") as h5:
+        actual_1 = np.array(h5["gradients"])
+        actual_2 = np.array(h5["lambdas"])
 
-    assert np.allclose(actual_1, expected_1)
-    assert np.allclose(actual_2, expected_2)
+    assert np.allclose(actual_1, expected_gradients)
+    assert np.allclose(actual_2, expected_lambdas)
 
 
-@pytest.mark.skipif(
-    IS_WINDOWS,
-    reason="Windows does not support writing to and reading from the same temporary file.",
-)
-def test_save_json() -> None:
+def test_save_json(
+    expected_gradients: np.ndarray, expected_lambdas: np.ndarray
+) -> None:
     """Test that the save_json function saves a dictionary to a json file
-    with the correct name and content.
+    with the correct content.
     """
-    expected_1 = np.array([1, 2, 3])
-    expected_2 = np.array([2, 3, 4])
+    buffer = io.BytesIO()
+
+    utils.save_json(expected_gradients, expected_lambdas, buffer)
+    actual = json.loads(buffer.getvalue())
+
+    assert actual["gradients"] == expected_gradients.tolist()
+    assert actual["lambdas"] == expected_lambdas.tolist()
+
+
+def test_save_json_without_orjson(
+    mocker: pytest_mock.MockerFixture,
+    expected_gradients: np.ndarray,
+    expected_lambdas: np.ndarray,
+) -> None:
+    """Test that save_json falls back to the standard library if orjson is not
+    installed.
+    """
+    mocker.patch.dict(sys.modules, {"orjson": None})
+    buffer = io.BytesIO()
 
-    with tempfile.NamedTemporaryFile(suffix=".json") as tmp_fb:
-        utils.save_json(expected_1, expected_2, tmp_fb.name)
-        with open(tmp_fb.name, "r", encoding="utf-8") as json_fb:
-            actual = json.load(json_fb)
+    utils.save_json(expected_gradients, expected_lambdas, buffer)
+    actual = json.loads(buffer.getvalue())
 
-    assert actual["gradients"] == expected_1.tolist()
-    assert actual["lambdas"] == expected_2.tolist()
+    assert actual["gradients"] == expected_gradients.tolist()
+    assert actual["lambdas"] == expected_lambdas.tolist()
 
 
-def test_save_internal_error() -> None:
-    """Test that the save_json function raises an error if the file extension is
+@pytest.mark.parametrize("encoder", ["orjson", "json"])
+def test_save_json_non_finite(mocker: pytest_mock.MockerFixture, encoder: str) -> None:
+    """Test that both JSON encoders write non-finite values as null."""
+    if encoder == "orjson":
+        pytest.importorskip("orjson")
+    else:
+        mocker.patch.dict(sys.modules, {"orjson": None})
+    gradients = np.array([[1.0, np.nan], [np.inf, -np.inf]])
+    buffer = io.BytesIO()
+
+    utils.save_json(gradients, np.array([np.nan, 2.0]), buffer)
+    actual = json.loads(buffer.getvalue())
+
+    assert actual == {"gradients": [[1.0, None], [None, None]], "lambdas": [None, 2.0]}
+
+
+def test_save_msgpack() -> None:
+    """Test that the save_msgpack function saves the arrays to a MessagePack
+    file from which they can be restored.
+    """
+    msgpack = pytest.importorskip("msgpack")
+    expected_1 = np.array([[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]]).T
+    expected_2 = np.array([2, 3, 4])
+    buffer = io.BytesIO()
+
+    utils.save_msgpack(expected_1, expected_2, buffer)
+    actual = msgpack.unpackb(buffer.getvalue())
+
+    actual_1, actual_2 = (
+        np.frombuffer(value["data"], value["dtype"]).reshape(value["shape"])
+        for value in (actual["gradients"], actual["lambdas"])
+    )
+    assert np.array_equal(actual_1, expected_1)
+    assert np.array_equal(actual_2, expected_2)
+
+
+@pytest.mark.parametrize("suffix", [".h5", ".json"])
+def test_save_dispatch(
+    output_dir: pathlib.Path,
+    expected_gradients: np.ndarray,
+    expected_lambdas: np.ndarray,
+    suffix: str,
+) -> None:
+    """Test that the save function writes a file for each supported suffix."""
+    filename = output_dir / f"dispatch{suffix}"
+
+    utils.save(expected_gradients, expected_lambdas, filename)
+
+    assert filename.stat().st_size > 0
+
+
+def test_save_float32(
+    output_dir: pathlib.Path,
+    expected_gradients: np.ndarray,
+    expected_lambdas: np.ndarray,
+) -> None:
+    """Test that the save function stores the arrays in single precision by
+    default."""
+    filename = output_dir / "float32.h5"
+
+    utils.save(expected_gradients, expected_lambdas, filename)
+    with h5py.File(filename, "r") as h5:
+        actual_1 = h5["gradients"].dtype
+        actual_2 = h5["lambdas"].dtype
+
+    assert actual_1 == np.float32
+    assert actual_2 == np.float32
+
+
+def test_save_internal_error(
+    output_dir: pathlib.Path,
+    expected_gradients: np.ndarray,
+    expected_lambdas: np.ndarray,
+) -> None:
+    """Test that the save function raises an error if the file extension is
     not known."""
     with pytest.raises(exceptions.InternalError):
-        utils.save(np.array([1, 2, 3]), np.array([2, 3, 4]), "wrong.extension")
+        utils.save(expected_gradients, expected_lambdas, output_dir / "wrong.extension")